@@ -1,7 +1,6 @@
 import argparse
-import copy
 import os
-from typing import Dict, Tuple
+from typing import Dict, Optional, Tuple
 
 import numpy as np
 import torch
@@ -37,8 +36,23 @@ parser.add_argument("--temporal_strategy", type=str, default="uniform")
 parser.add_argument("--share_same_time", action="store_true", default=True)
 # Whether to use shallow embedding on dst nodes or not.
 parser.add_argument("--use_shallow", action="store_true", default=True)
+# Whether to retrieve the top-k dst nodes with a FAISS inner-product index
+# instead of materializing the full [num_src, num_dst] score matrix.
+parser.add_argument(
+    "--use_faiss",
+    action="store_true",
+    help="Retrieve top-k dst nodes with a FAISS IndexFlatIP. Searches run "
+    "brute-force on the CPU (the declared faiss-cpu dependency) unless a "
+    "GPU-enabled FAISS build (faiss-gpu) is installed, in which case the "
+    "index stays resident on the GPU.",
+)
+# Number of dst nodes to score at once when retrieving the top-k dst nodes
+# without FAISS. Bounds peak memory to [batch_size, eval_dst_chunk_size].
+parser.add_argument("--eval_dst_chunk_size", type=int, default=131072)
+# Whether to compile the model and the loss computation via torch.compile.
+parser.add_argument("--compile", action="store_true")
 parser.add_argument("--max_steps_per_epoch", type=int, default=2000)
-parser.add_argument("--num_workers", type=int, default=0)
+parser.add_argument("--num_workers", type=int, default=8)
 parser.add_argument("--seed", type=int, default=42)
 parser.add_argument(
     "--cache_dir",
@@ -51,6 +65,10 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 if torch.cuda.is_available():
     torch.set_num_threads(1)
 seed_everything(args.seed)
+# Run the training forward pass in BF16 on GPUs with native BF16 support
+# (Ampere and newer; no loss scaling required), while parameters and
+# optimizer state stay in FP32:
+use_bf16 = torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8
 
 dataset: RelBenchDataset = get_dataset(name=args.dataset, process=False)
 task: LinkTask = dataset.get_task(args.task, process=True)
@@ -62,14 +80,28 @@ col_to_stype_dict = dataset2inferred_stypes[args.dataset]
 data, col_stats_dict = make_pkey_fkey_graph(
     dataset.db,
     col_to_stype_dict=col_to_stype_dict,
+    # Embeddings are only computed on the first run; the materialized tensor
+    # frames (including text embeddings) are cached in `cache_dir`.
     text_embedder_cfg=TextEmbedderConfig(
-        text_embedder=GloveTextEmbedding(device=device), batch_size=256
+        text_embedder=GloveTextEmbedding(device=device), batch_size=1024
     ),
     cache_dir=os.path.join(args.cache_dir, args.dataset),
 )
 
 num_neighbors = [int(args.num_neighbors // 2**i) for i in range(args.num_layers)]
 
+# Throttle progress bar refreshes, which are noticeable at short step times:
+tqdm_kwargs = {"mininterval": 1.0, "miniters": 50, "smoothing": 0}
+
+# Overlap neighbor sampling in worker processes with GPU compute:
+loader_kwargs = {
+    "num_workers": args.num_workers,
+    "pin_memory": device.type == "cuda",
+}
+if args.num_workers > 0:
+    loader_kwargs["persistent_workers"] = True
+    loader_kwargs["prefetch_factor"] = 4
+
 train_table_input = get_link_train_table_input(task.train_table, task)
 train_loader = LinkNeighborLoader(
     data=data,
@@ -84,37 +116,38 @@ train_loader = LinkNeighborLoader(
     temporal_strategy=args.temporal_strategy,
     # if share_same_time is True, we use sampler, so shuffle must be set False
     shuffle=not args.share_same_time,
-    num_workers=args.num_workers,
+    **loader_kwargs,
 )
 
 eval_loaders_dict: Dict[str, Tuple[NeighborLoader, NeighborLoader]] = {}
 for split in ["val", "test"]:
     seed_time = task.val_seed_time if split == "val" else task.test_seed_time
     target_table = task.val_table if split == "val" else task.test_table
-    src_node_indices = torch.from_numpy(target_table.df[task.src_entity_col].values)
+    src_node_indices = torch.from_numpy(
+        np.ascontiguousarray(target_table.df[task.src_entity_col].values, np.int64)
+    )
+    # All seeds share the same time, so broadcast a single value instead of
+    # allocating a dense tensor (the loader only gathers from it):
+    seed_time_tensor = torch.tensor(seed_time, dtype=torch.long)
     src_loader = NeighborLoader(
         data,
         num_neighbors=num_neighbors,
         time_attr="time",
         input_nodes=(task.src_entity_table, src_node_indices),
-        input_time=torch.full(
-            size=(len(src_node_indices),), fill_value=seed_time, dtype=torch.long
-        ),
+        input_time=seed_time_tensor.expand(len(src_node_indices)),
         batch_size=args.batch_size,
         shuffle=False,
-        num_workers=args.num_workers,
+        **loader_kwargs,
     )
     dst_loader = NeighborLoader(
         data,
         num_neighbors=num_neighbors,
         time_attr="time",
         input_nodes=task.dst_entity_table,
-        input_time=torch.full(
-            size=(task.num_dst_nodes,), fill_value=seed_time, dtype=torch.long
-        ),
+        input_time=seed_time_tensor.expand(task.num_dst_nodes),
         batch_size=args.batch_size,
         shuffle=False,
-        num_workers=args.num_workers,
+        **loader_kwargs,
     )
     eval_loaders_dict[split] = (src_loader, dst_loader)
 
@@ -128,81 +161,229 @@ model = Model(
     norm="layer_norm",
     shallow_list=[task.dst_entity_table] if args.use_shallow else [],
 ).to(device)
+if args.compile:
+    # Batch sizes and sampled subgraph sizes vary across mini-batches:
+    model = torch.compile(model, dynamic=True)
 optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
 
 
+def bpr_loss(
+    x_src: Tensor,
+    x_pos_dst: Tensor,
+    x_neg_dst: Tensor,
+    share_same_time: bool,
+) -> Tensor:
+    if share_same_time:
+        # [batch_size, 1]
+        pos_score = torch.sum(x_src * x_pos_dst, dim=1, keepdim=True)
+        # [batch_size, batch_size]
+        neg_score = x_src @ x_neg_dst.t()
+    else:
+        # [batch_size, ]
+        pos_score = torch.sum(x_src * x_pos_dst, dim=1)
+        # [batch_size, ]
+        neg_score = torch.sum(x_src * x_neg_dst, dim=1)
+    # softplus(-(pos - neg)) == softplus(neg - pos)
+    # Computed in FP32 since softplus underflows in BF16:
+    return F.softplus(neg_score.float() - pos_score.float()).mean()
+
+
+if args.compile:
+    bpr_loss = torch.compile(bpr_loss, dynamic=True)
+
+
 def train() -> float:
+    # Allow TF32 tensor cores for the remaining FP32 matmuls during training
+    # only, so that evaluation keeps the caller's precision setting:
+    prev_allow_tf32 = torch.backends.cuda.matmul.allow_tf32
+    torch.backends.cuda.matmul.allow_tf32 = True
+    try:
+        return _train()
+    finally:
+        torch.backends.cuda.matmul.allow_tf32 = prev_allow_tf32
+
+
+def _train() -> float:
     model.train()
 
-    loss_accum = count_accum = 0
+    # Accumulate the loss on device to avoid a host sync per step:
+    loss_accum = torch.zeros((), device=device)
+    count_accum = 0
     steps = 0
     total_steps = min(len(train_loader), args.max_steps_per_epoch)
-    for batch in tqdm(train_loader, total=total_steps):
+    for batch in tqdm(train_loader, total=total_steps, **tqdm_kwargs):
         src_batch, batch_pos_dst, batch_neg_dst = batch
         src_batch, batch_pos_dst, batch_neg_dst = (
-            src_batch.to(device),
-            batch_pos_dst.to(device),
-            batch_neg_dst.to(device),
+            src_batch.to(device, non_blocking=True),
+            batch_pos_dst.to(device, non_blocking=True),
+            batch_neg_dst.to(device, non_blocking=True),
         )
-        x_src = model(src_batch, task.src_entity_table)
-        x_pos_dst = model(batch_pos_dst, task.dst_entity_table)
-        x_neg_dst = model(batch_neg_dst, task.dst_entity_table)
-
-        # [batch_size, ]
-        pos_score = torch.sum(x_src * x_pos_dst, dim=1)
-        if args.share_same_time:
-            # [batch_size, batch_size]
-            neg_score = x_src @ x_neg_dst.t()
-            # [batch_size, 1]
-            pos_score = pos_score.view(-1, 1)
-        else:
-            # [batch_size, ]
-            neg_score = torch.sum(x_src * x_neg_dst, dim=1)
+        with torch.autocast(
+            device_type=device.type, dtype=torch.bfloat16, enabled=use_bf16
+        ):
+            x_src = model(src_batch, task.src_entity_table)
+            x_pos_dst = model(batch_pos_dst, task.dst_entity_table)
+            x_neg_dst = model(batch_neg_dst, task.dst_entity_table)
+            loss = bpr_loss(x_src, x_pos_dst, x_neg_dst, args.share_same_time)
         optimizer.zero_grad()
-        # BPR loss
-        diff_score = pos_score - neg_score
-        loss = F.softplus(-diff_score).mean()
         loss.backward()
         optimizer.step()
 
-        loss_accum += float(loss) * x_src.size(0)
+        loss_accum += loss.detach() * x_src.size(0)
         count_accum += x_src.size(0)
 
         steps += 1
         if steps > args.max_steps_per_epoch:
             break
 
-    return loss_accum / count_accum
+    return loss_accum.item() / count_accum
 
 
 @torch.no_grad()
-def test(src_loader: NeighborLoader, dst_loader: NeighborLoader) -> np.ndarray:
+def compute_dst_emb(dst_loader: NeighborLoader) -> Tensor:
     model.eval()
 
     dst_embs: list[Tensor] = []
-    for batch in tqdm(dst_loader):
-        batch = batch.to(device)
+    for batch in tqdm(dst_loader, **tqdm_kwargs):
+        batch = batch.to(device, non_blocking=True)
         emb = model(batch, task.dst_entity_table).detach()
         dst_embs.append(emb)
-    dst_emb = torch.cat(dst_embs, dim=0)
-    del dst_embs
+    return torch.cat(dst_embs, dim=0)
+
+
+def build_faiss_index(dst_emb: Tensor) -> Tuple["faiss.Index", bool]:
+    r"""Builds an inner-product index over :obj:`dst_emb`. Returns the index
+    and whether it is resident on the GPU."""
+    import faiss
+
+    # Lets FAISS indices consume and return PyTorch tensors directly:
+    import faiss.contrib.torch_utils  # noqa: F401
+
+    index = faiss.IndexFlatIP(dst_emb.size(1))
+    on_gpu = device.type == "cuda" and hasattr(faiss, "StandardGpuResources")
+    if on_gpu:
+        index = faiss.index_cpu_to_gpu(
+            faiss.StandardGpuResources(), torch.cuda.current_device(), index
+        )
+    else:
+        dst_emb = dst_emb.cpu()
+    index.add(dst_emb.float().contiguous())
+    return index, on_gpu
+
+
+def chunked_topk(emb: Tensor, dst_emb: Tensor, k: int, chunk_size: int) -> Tensor:
+    r"""Returns the indices of the top-:obj:`k` inner products between
+    :obj:`emb` and :obj:`dst_emb`, while only materializing scores for
+    :obj:`chunk_size` destination nodes at a time."""
+    top_val = emb.new_empty((emb.size(0), 0))
+    top_index = torch.empty((emb.size(0), 0), dtype=torch.long, device=emb.device)
+    for start in range(0, dst_emb.size(0), chunk_size):
+        score = emb @ dst_emb[start : start + chunk_size].t()
+        val, index = torch.topk(score, k=min(k, score.size(1)), dim=1)
+        # Merge the chunk's top-k with the running top-k:
+        val = torch.cat([top_val, val], dim=1)
+        index = torch.cat([top_index, index + start], dim=1)
+        top_val, perm = torch.topk(val, k=min(k, val.size(1)), dim=1)
+        top_index = index.gather(1, perm)
+    return top_index
+
+
+def check_chunked_topk() -> None:
+    r"""Sanity-checks :meth:`chunked_topk` against a dense :meth:`torch.topk`,
+    including a chunk size that does not divide the number of dst nodes and a
+    final chunk with fewer than :obj:`k` dst nodes."""
+    generator = torch.Generator().manual_seed(0)
+    emb = torch.randn(8, 16, dtype=torch.float64, generator=generator)
+    dst_emb = torch.randn(103, 16, dtype=torch.float64, generator=generator)
+    k = 5
+    _, expected = torch.topk(emb @ dst_emb.t(), k=k, dim=1)
+    # 103 = 10 * 10 + 3 and 103 = 14 * 7 + 5, i.e., a last chunk of size
+    # smaller than and equal to k, respectively:
+    for chunk_size in [10, 7, 103, 1024]:
+        out = chunked_topk(emb, dst_emb, k, chunk_size)
+        assert torch.equal(out, expected), f"chunked_topk mismatch ({chunk_size=})"
+
+
+check_chunked_topk()
+
+
+@torch.no_grad()
+def rank_src(src_loader: NeighborLoader, dst_emb: Tensor) -> np.ndarray:
+    model.eval()
+
+    index, index_on_gpu = (
+        build_faiss_index(dst_emb) if args.use_faiss else (None, False)
+    )
+
+    # Copy predictions to the host on a side stream through a ring of two
+    # pinned buffers, so that the copy of one batch overlaps with the compute
+    # of the next one:
+    async_copy = device.type == "cuda" and (index is None or index_on_gpu)
+    if async_copy:
+        copy_stream = torch.cuda.Stream()
+        host_bufs = [
+            torch.empty((args.batch_size, task.eval_k), dtype=torch.long).pin_memory()
+            for _ in range(2)
+        ]
+    pending: Optional[Tuple[Tensor, torch.cuda.Event]] = None
 
     pred_index_mat_list: list[Tensor] = []
-    for batch in tqdm(src_loader):
-        batch = batch.to(device)
+    for i, batch in enumerate(tqdm(src_loader, **tqdm_kwargs)):
+        batch = batch.to(device, non_blocking=True)
         emb = model(batch, task.src_entity_table)
-        _, pred_index_mat = torch.topk(emb @ dst_emb.t(), k=task.eval_k, dim=1)
-        pred_index_mat_list.append(pred_index_mat.cpu())
+        if index is not None:
+            query = emb.float() if index_on_gpu else emb.float().cpu()
+            _, pred_index_mat = index.search(query.contiguous(), task.eval_k)
+        else:
+            pred_index_mat = chunked_topk(
+                emb, dst_emb, task.eval_k, args.eval_dst_chunk_size
+            )
+
+        if not async_copy:
+            pred_index_mat_list.append(pred_index_mat.cpu())
+            continue
+
+        copy_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(copy_stream):
+            host_buf = host_bufs[i % 2][: pred_index_mat.size(0)]
+            host_buf.copy_(pred_index_mat, non_blocking=True)
+            pred_index_mat.record_stream(copy_stream)
+            event = torch.cuda.Event()
+            event.record()
+
+        # The current batch is enqueued, now collect the previous one:
+        if pending is not None:
+            pending[1].synchronize()
+            pred_index_mat_list.append(pending[0].clone())
+        pending = (host_buf, event)
+
+    if pending is not None:
+        pending[1].synchronize()
+        pred_index_mat_list.append(pending[0].clone())
     pred = torch.cat(pred_index_mat_list, dim=0).numpy()
     return pred
 
 
+def test(
+    src_loader: NeighborLoader,
+    dst_loader: NeighborLoader,
+    dst_emb: Optional[Tensor] = None,
+) -> Tuple[np.ndarray, Tensor]:
+    r"""Ranks destination nodes for every source node. If :obj:`dst_emb` is
+    given, it is assumed to stem from the current model weights and the
+    (expensive) pass over :obj:`dst_loader` is skipped."""
+    if dst_emb is None:
+        dst_emb = compute_dst_emb(dst_loader)
+    return rank_src(src_loader, dst_emb), dst_emb
+
+
 state_dict = None
+best_val_dst_emb = None
 best_val_metric = 0
 for epoch in range(1, args.epochs + 1):
     train_loss = train()
     if epoch % args.eval_epochs_interval == 0:
-        val_pred = test(*eval_loaders_dict["val"])
+        val_pred, val_dst_emb = test(*eval_loaders_dict["val"])
         val_metrics = task.evaluate(val_pred, task.val_table)
         print(
             f"Epoch: {epoch:02d}, Train loss: {train_loss}, "
@@ -211,14 +392,41 @@ for epoch in range(1, args.epochs + 1):
 
         if val_metrics[tune_metric] >= best_val_metric:
             best_val_metric = val_metrics[tune_metric]
-            state_dict = copy.deepcopy(model.state_dict())
+            # Snapshot the weights into (pinned) host memory that is allocated
+            # once, rather than deep-copying them on the GPU:
+            if state_dict is None:
+                state_dict = {
+                    key: torch.empty_like(
+                        value, device="cpu", pin_memory=device.type == "cuda"
+                    )
+                    for key, value in model.state_dict().items()
+                }
+            for key, value in model.state_dict().items():
+                state_dict[key].copy_(value, non_blocking=True)
+            # Keep the destination embeddings of the best model around so that
+            # the final validation pass does not need to recompute them. They
+            # live in host memory next to the weight snapshot, so that no
+            # second [num_dst, channels] tensor occupies GPU memory:
+            if best_val_dst_emb is None:
+                best_val_dst_emb = torch.empty_like(
+                    val_dst_emb, device="cpu", pin_memory=device.type == "cuda"
+                )
+            best_val_dst_emb.copy_(val_dst_emb, non_blocking=True)
+        del val_dst_emb
 
 
+if device.type == "cuda":
+    # Wait for the asynchronous device-to-host snapshot copies:
+    torch.cuda.synchronize()
 model.load_state_dict(state_dict)
-val_pred = test(*eval_loaders_dict["val"])
+val_pred, _ = test(
+    *eval_loaders_dict["val"],
+    dst_emb=best_val_dst_emb.to(device, non_blocking=True),
+)
+del best_val_dst_emb
 val_metrics = task.evaluate(val_pred, task.val_table)
 print(f"Best Val metrics: {val_metrics}")
 
-test_pred = test(*eval_loaders_dict["test"])
+test_pred, _ = test(*eval_loaders_dict["test"])
 test_metrics = task.evaluate(test_pred)
 print(f"Best test metrics: {test_metrics}")
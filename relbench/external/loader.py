@@ -137,10 +137,15 @@ class CustomLinkDataset(Dataset):
         assert len(src_node_indices) == len(dst_node_indices) and len(
             src_node_indices
         ) == len(src_time)
+        assert dst_node_indices.layout == torch.sparse_csr
         self.src_node_indices = src_node_indices
         self.dst_node_indices = dst_node_indices
         self.num_dst_nodes = num_dst_nodes
         self.src_time = src_time
+        # Slice rows directly from the CSR buffers instead of materializing a
+        # sparse COO row tensor on every call:
+        self._crow_indices = dst_node_indices.crow_indices()
+        self._col_indices = dst_node_indices.col_indices()
 
     def __getitem__(self, index) -> Tensor:
         r"""Returns 1-dim tensor of size 3
@@ -148,10 +153,12 @@ class CustomLinkDataset(Dataset):
         - positive destination node index
         - source node time
         """
+        start = int(self._crow_indices[index])
+        end = int(self._crow_indices[index + 1])
         return torch.tensor(
             [
                 self.src_node_indices[index],
-                random.choice(self.dst_node_indices[index].indices()[0]),
+                self._col_indices[random.randrange(start, end)],
                 self.src_time[index],
             ]
         )